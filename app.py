@@ -1,38 +1,143 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, render_template_string, make_response
 import osmnx as ox
-import networkx as nx
+import shapely
 from shapely.geometry import Point, Polygon
+from shapely.strtree import STRtree
 from datetime import datetime
 import logging
-from haversine import haversine
+from logging.handlers import MemoryHandler
+import os
+import itertools
+import threading
+import hashlib
 import folium
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from functools import lru_cache
+from numba import njit
 
 app = Flask(__name__)
 
 # -----------------------------
 # Logging setup
 # -----------------------------
-logging.basicConfig(filename="activity.log", level=logging.INFO)
+# Records are buffered and written to disk in batches of 100 (or on ERROR/exit)
+_log_file = logging.FileHandler("activity.log")
+_log_file.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_buffer = MemoryHandler(capacity=100, target=_log_file)
+logging.getLogger().addHandler(_log_buffer)
+logging.getLogger().setLevel(logging.INFO)
 def log_activity(msg):
     logging.info(f"{datetime.utcnow()}: {msg}")
 
+def tail_lines(path, n=50, chunk_size=8192):
+    """Last n lines of a file, reading backwards from the end in chunks."""
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(chunk_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    return [line.decode("utf-8", errors="replace") for line in data.splitlines(keepends=True)[-n:]]
+
 # -----------------------------
 # Real-time data stores
 # -----------------------------
-drivers = [
+EARTH_RADIUS_KM = 6371.0088  # same mean radius as the haversine package
+
+class DriverTable:
+    """Drivers stored column-wise so distance scans run over contiguous arrays."""
+
+    def __init__(self, rows=()):
+        # guards every column write; re-entrant so callers can hold it across
+        # a read-decide-charge sequence
+        self.lock = threading.RLock()
+        self.ids, self.imei, self.names = [], [], []
+        self.lat = np.empty(0, dtype=float)
+        self.lon = np.empty(0, dtype=float)
+        self.load = np.empty(0, dtype=np.int64)
+        # radian forms cached per driver so distance scans skip redundant trig
+        self.rlat = np.empty(0, dtype=float)
+        self.rlon = np.empty(0, dtype=float)
+        self.cos_rlat = np.empty(0, dtype=float)
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, row):
+        # convert first so bad input raises before any column is touched
+        lat, lon, load = float(row['lat']), float(row['lon']), int(row['current_load'])
+        rlat, rlon = np.radians(lat), np.radians(lon)
+        with self.lock:
+            self.ids.append(row['id'])
+            self.imei.append(row['imei'])
+            self.names.append(row['driver'])
+            self.lat = np.concatenate([self.lat, [lat]])
+            self.lon = np.concatenate([self.lon, [lon]])
+            self.load = np.concatenate([self.load, [load]])
+            self.rlat = np.concatenate([self.rlat, [rlat]])
+            self.rlon = np.concatenate([self.rlon, [rlon]])
+            self.cos_rlat = np.concatenate([self.cos_rlat, [np.cos(rlat)]])
+
+    def charge(self, i):
+        """Add one delivery to driver i's load and return the updated row."""
+        with self.lock:
+            self.load[i] += 1
+            return self.row(i)
+
+    def row(self, i):
+        return {
+            "id": self.ids[i],
+            "imei": self.imei[i],
+            "driver": self.names[i],
+            "lat": float(self.lat[i]),
+            "lon": float(self.lon[i]),
+            "current_load": int(self.load[i]),
+        }
+
+drivers = DriverTable([
     {"id":1,"imei":"123456789012345","driver":"Alice","lat":14.5547,"lon":121.0244,"current_load":1},
     {"id":2,"imei":"234567890123456","driver":"Bob","lat":14.5550,"lon":121.0300,"current_load":2},
     {"id":3,"imei":"345678901234567","driver":"Charlie","lat":14.5600,"lon":121.0200,"current_load":0},
-]
+])
 
 deliveries = []  # real-time delivery requests
 
+# next(count) is atomic under the GIL, unlike len(list)+1 across request threads
+_driver_id = itertools.count(len(drivers) + 1)
+_delivery_id = itertools.count(1)
+
+# Bumped on every driver/delivery mutation; keys the rendered-map cache
+_state_version = 0
+
+def _bump_state():
+    global _state_version
+    _state_version += 1
+
 geofences = [
     {"id":1,"name":"No-Go Zone Makati","polygon":[(14.555,121.023),(14.556,121.023),(14.556,121.025),(14.555,121.025)]}
 ]
 
+# Geofence index; call _rebuild_geofence_index() whenever `geofences` changes
+_gf_polys, _gf_tree = [], None
+
+def _rebuild_geofence_index():
+    global _gf_polys, _gf_tree
+    for gf in geofences:
+        gf['_poly'] = Polygon(gf['polygon'])
+    _gf_polys = [gf['_poly'] for gf in geofences]
+    shapely.prepare(_gf_polys)  # in place, so gf['_poly'].contains is prepared too
+    _gf_tree = STRtree(_gf_polys)
+
+_rebuild_geofence_index()
+
 # -----------------------------
 # Load Makati City Graph safely
 # -----------------------------
@@ -45,63 +150,172 @@ except Exception as e:
     north, south, east, west = 14.569, 14.535, 121.043, 121.008
     G = ox.graph_from_bbox(north, south, east, west, network_type="drive")
 
+# Spatial index over graph nodes for nearest-node lookups. Nodes are projected
+# once onto an equirectangular plane (metres) centred on the city, which keeps
+# nearest-neighbour order at this scale while letting the KDTree use plain
+# Euclidean distance.
+node_ids = list(G.nodes)
+nodes_xy = np.array([[G.nodes[n]['x'], G.nodes[n]['y']] for n in node_ids])
+_proj_cos_lat0 = np.cos(np.radians(nodes_xy[:, 1].mean()))
+
+def _project(lon, lat):
+    x = EARTH_RADIUS_KM * 1000 * np.radians(lon) * _proj_cos_lat0
+    y = EARTH_RADIUS_KM * 1000 * np.radians(lat)
+    return np.column_stack([x, y]) if np.ndim(lon) else np.array([x, y])
+
+_kdtree = cKDTree(_project(nodes_xy[:, 0], nodes_xy[:, 1]))
+
+# CSR adjacency for C-level Dijkstra; parallel edges keep the shortest length
+node_index = {n: i for i, n in enumerate(node_ids)}
+_edge_len = {}
+for u, v, length in G.edges(data='length', default=0.0):
+    key = (node_index[u], node_index[v])
+    _edge_len[key] = min(length, _edge_len.get(key, length))
+_rows, _cols = zip(*_edge_len) if _edge_len else ((), ())
+csr = csr_matrix((list(_edge_len.values()), (_rows, _cols)), shape=(len(node_ids), len(node_ids)))
+
 # -----------------------------
 # Helper functions
 # -----------------------------
+@lru_cache(maxsize=8192)
+def nearest_node(latlon_key):
+    lat, lon = latlon_key
+    _, i = _kdtree.query(_project(lon, lat))
+    return node_ids[i]
+
+def _latlon_key(latlon):
+    # 6 decimals ~ 0.1 m, so repeat pickups/drop-offs hit the cache
+    return (round(latlon[0], 6), round(latlon[1], 6))
+
+@lru_cache(maxsize=4096)
+def _route_by_node(orig_node, dest_node):
+    orig_idx, dest_idx = node_index[orig_node], node_index[dest_node]
+    dist_matrix, predecessors = dijkstra(csr, indices=orig_idx, return_predecessors=True)
+    distance_m = float(dist_matrix[dest_idx])
+    if np.isinf(distance_m):
+        return (), 0
+    path = [dest_idx]
+    while path[-1] != orig_idx:
+        path.append(predecessors[path[-1]])
+    coords = tuple((G.nodes[node_ids[i]]['y'], G.nodes[node_ids[i]]['x']) for i in reversed(path))
+    # approximate ETA: assume 30 km/h ~ 500 m/min
+    eta_min = distance_m / 500
+    return coords, round(eta_min, 1)
+
 def suggest_route(origin, destination):
     try:
-        orig_node = ox.nearest_nodes(G, origin[1], origin[0])
-        dest_node = ox.nearest_nodes(G, destination[1], destination[0])
-        nodes = nx.shortest_path(G, orig_node, dest_node, weight='length')
-        coords = [(G.nodes[n]['y'], G.nodes[n]['x']) for n in nodes]
-        # approximate ETA: assume 30 km/h ~ 500 m/min
-        distance_m = sum(ox.utils_graph.get_route_edge_attributes(G, nodes, 'length'))
-        eta_min = distance_m / 500
-        return coords, round(eta_min, 1)
+        orig_node = nearest_node(_latlon_key(origin))
+        dest_node = nearest_node(_latlon_key(destination))
+        coords, eta = _route_by_node(orig_node, dest_node)
+        return list(coords), eta
     except:
         return [], 0
 
-def assign_driver(delivery):
-    best_driver = min(
-        drivers,
-        key=lambda d: haversine((d['lat'], d['lon']),(delivery['lat'], delivery['lon'])) + d['current_load']
-    )
-    delivery['assigned_driver'] = best_driver['id']
-    best_driver['current_load'] += 1
-    log_activity(f"Assigned delivery {delivery['id']} to driver {best_driver['driver']}")
-    return best_driver
+def _commit_assignment(delivery, idx):
+    driver = drivers.charge(idx)
+    delivery['assigned_driver'] = driver['id']
+    log_activity(f"Assigned delivery {delivery['id']} to driver {driver['driver']}")
+    return driver
+
+def build_cost_matrix(pending):
+    """(K, N) great-circle distances in km from each pending delivery to each driver."""
+    rlat0 = np.radians(np.array([d['lat'] for d in pending], dtype=float))[:, None]
+    rlon0 = np.radians(np.array([d['lon'] for d in pending], dtype=float))[:, None]
+    # drivers' radians and cos(lat) come precomputed from DriverTable
+    a = np.sin((drivers.rlat - rlat0) / 2) ** 2 + np.cos(rlat0) * drivers.cos_rlat * np.sin((drivers.rlon - rlon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+@njit(cache=True)
+def greedy_assign(cost, loads):
+    """Driver index per cost row, charging each pick before the next row.
+
+    Fuses the add-load + argmin of every row into one compiled pass instead of
+    allocating a temporary per delivery. `loads` is updated in place.
+    """
+    picks = np.empty(cost.shape[0], dtype=np.int64)
+    for i in range(cost.shape[0]):
+        best, best_cost = 0, cost[i, 0] + loads[0]
+        for j in range(1, cost.shape[1]):
+            c = cost[i, j] + loads[j]
+            if c < best_cost:
+                best, best_cost = j, c
+        picks[i] = best
+        loads[best] += 1
+    return picks
+
+# Streaming clusterer, warm-started lazily from deliveries it hasn't seen yet
+_mbk = MiniBatchKMeans(n_clusters=2, random_state=42, n_init=3)
+_mbk_seen = set()
+_mbk_lock = threading.Lock()
+
+def _fit_clusters(deliveries):
+    new = [d for d in deliveries if d['id'] not in _mbk_seen]
+    if not new or (not hasattr(_mbk, 'cluster_centers_') and len(new) < _mbk.n_clusters):
+        # first fit needs at least n_clusters points to seed the centers
+        return
+    _mbk.partial_fit(np.array([[d['lat'], d['lon']] for d in new], dtype=float))
+    _mbk_seen.update(d['id'] for d in new)
 
 def cluster_deliveries(deliveries, n_clusters=2):
-    if len(deliveries) <= 1: return {0: deliveries}
+    if len(deliveries) <= n_clusters: return {0: deliveries}
     coords = np.array([[d['lat'], d['lon']] for d in deliveries])
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42).fit(coords)
+    if n_clusters == _mbk.n_clusters:
+        with _mbk_lock:
+            _fit_clusters(deliveries)
+            labels = _mbk.predict(coords)
+    else:
+        labels = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, n_init=3).fit(coords).labels_
     clusters = {i: [] for i in range(n_clusters)}
-    for idx, label in enumerate(kmeans.labels_):
+    for idx, label in enumerate(labels):
         clusters[label].append(deliveries[idx])
     return clusters
 
 def check_geofence(lat, lon):
     point = Point(lat, lon)
-    for gf in geofences:
-        poly = Polygon(gf['polygon'])
-        if poly.contains(point):
+    # STRtree narrows to bbox hits; sort to keep first-match order of `geofences`
+    for i in sorted(_gf_tree.query(point)):
+        gf = geofences[i]
+        if gf['_poly'].contains(point):
             return gf['name']
     return None
 
-def plot_map():
+def geofence_mask(lats, lons):
+    """Boolean array, True where (lat, lon) falls inside any geofence."""
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    inside = np.zeros(lats.shape, dtype=bool)
+    for poly in _gf_polys:
+        inside |= shapely.contains_xy(poly, lats, lons)
+    return inside
+
+@lru_cache(maxsize=1)
+def _render_map(state_version):
     m = folium.Map(location=[14.5547,121.0244], zoom_start=13)
     # Drivers
-    for d in drivers:
-        folium.Marker([d['lat'], d['lon']], popup=d['driver'], icon=folium.Icon(color='blue')).add_to(m)
+    fg_drivers = folium.FeatureGroup(name="Drivers")
+    for i, (lat, lon, name) in enumerate(zip(drivers.lat, drivers.lon, drivers.names)):
+        fg_drivers.add_child(folium.Marker([lat, lon], popup=name, icon=folium.Icon(color='blue')), name=f"d{drivers.ids[i]}")
     # Deliveries
+    fg_deliveries = folium.FeatureGroup(name="Deliveries")
     for deliv in deliveries:
         color = 'green' if deliv.get('assigned_driver') else 'red'
-        folium.Marker([deliv['lat'], deliv['lon']], popup=f"Delivery {deliv['id']}", icon=folium.Icon(color=color)).add_to(m)
+        fg_deliveries.add_child(folium.Marker([deliv['lat'], deliv['lon']], popup=f"Delivery {deliv['id']}", icon=folium.Icon(color=color)), name=f"j{deliv['id']}")
     # Geofences
+    fg_geofences = folium.FeatureGroup(name="Geofences")
     for gf in geofences:
-        folium.Polygon(gf['polygon'], color='red', fill=True, fill_opacity=0.3, popup=gf['name']).add_to(m)
+        fg_geofences.add_child(folium.Polygon(gf['polygon'], color='red', fill=True, fill_opacity=0.3, popup=gf['name']), name=f"g{gf['id']}")
+    for fg in (fg_drivers, fg_deliveries, fg_geofences):
+        m.add_child(fg)
     return m._repr_html_()
 
+def plot_map():
+    return _render_map(_state_version)
+
+_boot_id = datetime.utcnow().isoformat()
+
+def map_etag():
+    # boot id keeps a restarted process from reusing an old version's tag
+    return hashlib.blake2b(f"{_boot_id}:{_state_version}".encode(), digest_size=8).hexdigest()
+
 # -----------------------------
 # API Endpoints
 # -----------------------------
@@ -113,7 +327,7 @@ def add_delivery():
     if isinstance(data, list):  
         for d in data:
             delivery = {
-                "id": len(deliveries)+1,
+                "id": next(_delivery_id),
                 "lat": d['lat'],
                 "lon": d['lon'],
                 "address": d.get('address','Unknown'),
@@ -123,10 +337,11 @@ def add_delivery():
             deliveries.append(delivery)
             log_activity(f"New delivery request {delivery['id']} at {delivery['lat']},{delivery['lon']}")
             added.append(delivery)
+        _bump_state()
         return jsonify({"status": "success", "deliveries": added})
     else:  # single delivery
         delivery = {
-            "id": len(deliveries)+1,
+            "id": next(_delivery_id),
             "lat": data['lat'],
             "lon": data['lon'],
             "address": data.get('address','Unknown'),
@@ -135,19 +350,31 @@ def add_delivery():
         }
         deliveries.append(delivery)
         log_activity(f"New delivery request {delivery['id']} at {delivery['lat']},{delivery['lon']}")
+        _bump_state()
         return jsonify({"status":"success","delivery":delivery})
 
 
 @app.route("/delivery/assign", methods=["GET"])
 def assign_all():
     response = []
-    for d in deliveries:
-        if d['assigned_driver']:
-            continue
-        if check_geofence(d['lat'], d['lon']):
-            log_activity(f"Delivery {d['id']} inside geofence, skipping")
-            continue
-        driver = assign_driver(d)
+    # Snapshot, geofence filter and greedy pass all run under the lock so two
+    # concurrent requests can't both pick up the same unassigned delivery, and
+    # /driver/add can't grow the load column mid-pass. Each row picks the
+    # cheapest driver given the loads accumulated by the rows before it.
+    assigned = []
+    with drivers.lock:
+        pending = [d for d in deliveries if not d['assigned_driver']]
+        blocked = geofence_mask([d['lat'] for d in pending], [d['lon'] for d in pending])
+        for d, skip in zip(pending, blocked):
+            if skip:
+                log_activity(f"Delivery {d['id']} inside geofence, skipping")
+        pending = [d for d, skip in zip(pending, blocked) if not skip]
+        if pending and len(drivers):
+            picks = greedy_assign(build_cost_matrix(pending), drivers.load.copy())
+            for d, idx in zip(pending, picks):
+                assigned.append((d, _commit_assignment(d, int(idx))))
+
+    for d, driver in assigned:
         route_coords, eta = suggest_route((driver['lat'], driver['lon']), (d['lat'], d['lon']))
         d['eta_min'] = eta
         d['route_coords'] = route_coords
@@ -156,6 +383,8 @@ def assign_all():
             "driver": driver['driver'],
             "eta_min": eta
         })
+    if response:
+        _bump_state()
 
     map_html = plot_map()
 
@@ -175,7 +404,14 @@ def assign_all():
 
 @app.route("/map", methods=["GET"])
 def get_map():
-    return plot_map()
+    etag = map_etag()
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(plot_map())
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, max-age=5"
+    return resp
 
 @app.route("/geofence/check", methods=["POST"])
 def process_geofence():
@@ -185,9 +421,8 @@ def process_geofence():
 
 @app.route("/activity_logs", methods=["GET"])
 def get_logs():
-    with open("activity.log") as f:
-        logs = f.readlines()
-    return jsonify({"logs": logs[-50:]})
+    _log_buffer.flush()
+    return jsonify({"logs": tail_lines("activity.log", 50)})
 
 @app.route("/driver/add", methods=["POST"])
 def add_driver():
@@ -196,33 +431,39 @@ def add_driver():
         added = []
         for d in data:
             driver = {
-                "id": len(drivers) + 1,
+                "id": next(_driver_id),
                 "imei": d.get("imei", "000000000000000"),
                 "driver": d["driver"],
                 "lat": d["lat"],
                 "lon": d["lon"],
                 "current_load": 0
             }
-            drivers.append(driver)
+            drivers.add(driver)
             log_activity(f"Added driver {driver['driver']}")
             added.append(driver)
+        _bump_state()
         return jsonify({"status": "success", "drivers": added})
     else:  # single driver
         driver = {
-            "id": len(drivers) + 1,
+            "id": next(_driver_id),
             "imei": data.get("imei", "000000000000000"),
             "driver": data["driver"],
             "lat": data["lat"],
             "lon": data["lon"],
             "current_load": 0
         }
-        drivers.append(driver)
+        drivers.add(driver)
         log_activity(f"Added driver {driver['driver']}")
+        _bump_state()
         return jsonify({"status": "success", "driver": driver})
 
 
 # -----------------------------
 # Run Flask
 # -----------------------------
+# Development: python app.py
+# Production:  gunicorn -w 1 --threads 8 app:app
+# Keep a single worker process: drivers, deliveries, id counters and the map
+# ETag all live in memory, so extra workers would each see a different fleet.
 if __name__ == "__main__":
     app.run(debug=True)
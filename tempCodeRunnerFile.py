@@ -5,7 +5,8 @@ import networkx as nx
 from shapely.geometry import Point, Polygon
 from datetime import datetime, timedelta
 import logging
-from haversine import haversine
+import math
+from operator import itemgetter
 import folium
 from sklearn.cluster import KMeans
 import numpy as np
@@ -48,17 +49,26 @@ def suggest_route(origin, destination):
         dest_node = ox.nearest_nodes(G, destination[1], destination[0])
         nodes = nx.shortest_path(G, orig_node, dest_node, weight='length')
         coords = [(G.nodes[n]['y'], G.nodes[n]['x']) for n in nodes]
-        distance_m = sum(nx.shortest_path_length(G, orig_node, dest_node, weight='length') for n in nodes)
+        distance_m = nx.shortest_path_length(G, orig_node, dest_node, weight='length')
         eta_min = distance_m / 500  # assume 30 km/h ~ 500 m/min
         return coords, round(eta_min, 1)
     except:
         return [], 0
 
+def _hav(a_lat, a_lon, b_lat, b_lon):
+    # great-circle km; inputs are known-valid so skip the library's range checks
+    p = math.pi / 180
+    a = 0.5 - math.cos((b_lat - a_lat) * p) / 2 + math.cos(a_lat * p) * math.cos(b_lat * p) * (1 - math.cos((b_lon - a_lon) * p)) / 2
+    return 12742.0176 * math.asin(math.sqrt(a))
+
+_driver_pos_load = itemgetter('lat', 'lon', 'current_load')
+
 def assign_driver(delivery):
-    best_driver = min(
-        drivers,
-        key=lambda d: haversine((d['lat'], d['lon']),(delivery['lat'], delivery['lon'])) + d['current_load']
-    )
+    b_lat, b_lon = delivery['lat'], delivery['lon']
+    def cost(d):
+        lat, lon, load = _driver_pos_load(d)
+        return _hav(lat, lon, b_lat, b_lon) + load
+    best_driver = min(drivers, key=cost)
     delivery['assigned_driver'] = best_driver['id']
     best_driver['current_load'] += 1
     log_activity(f"Assigned delivery {delivery['id']} to driver {best_driver['driver']}")